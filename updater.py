@@ -1,17 +1,14 @@
 # IMPORTS -------------------------------------------------------------------- #
 
 import copy
+import functools
 import json
 import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-import numpy as np
-import pandas as pd
+import orjson
 import requests
 from tqdm import tqdm
-import warnings
-
-warnings.simplefilter(action="ignore", category=FutureWarning)
-
 
 # CONSTANTS ------------------------------------------------------------------ #
 
@@ -22,6 +19,9 @@ PROVIDER = "Canton Zurich"
 SHOP_METADATA_LINK = "https://www.web.statistik.zh.ch/ogd/daten/zhweb.json"
 SHOP_ABBR = "ktzh"
 
+# Timeout in seconds for requests to the data shop.
+REQUEST_TIMEOUT = 30
+
 GITHUB_ACCOUNT = "openZH"
 REPO_NAME = "starter-code-openZH"
 REPO_BRANCH = "main"
@@ -61,190 +61,288 @@ KEYS_DISTRIBUTION = [
     "rights",
 ]
 
+# Labels of the metadata features, formatted once rather than for every record.
+_DATASET_LABELS = [(k, f"- **{k.capitalize()}** `") for k in KEYS_DATASET]
+_DISTRIBUTION_LABELS = [(k, f"# {k.capitalize():<25}: ") for k in KEYS_DISTRIBUTION]
+
+# Fields needed to populate the code file templates.
+CODEBOOK_KEYS = [
+    "identifier",
+    "title",
+    "description",
+    "metadata",
+    "contact",
+    "distributions",
+    "distribution_links",
+    "title_py",
+    "description_py",
+    "metadata_py",
+]
+
+# Count of datasets that are sent to a worker process at once.
+PARALLEL_CHUNK_SIZE = 50
+
+# Count of threads per worker process that write the created files to disk.
+WRITE_THREADS = 16
+
+# Precompiled patterns used repeatedly while composing code files.
+_NEWLINE_RE = re.compile(r"\n+")
+_PLACEHOLDER_RE = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+
+# Reuse connections (keep-alive) for all requests to the data shop.
+_HTTP = requests.Session()
+_HTTP.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=20))
+
 
 # FUNCTIONS ------------------------------------------------------------------ #
 
 
 def get_current_json():
     """Request metadata catalogue from data shop."""
-    res = requests.get(SHOP_METADATA_LINK)
+    res = _HTTP.get(SHOP_METADATA_LINK, timeout=REQUEST_TIMEOUT)
     # # Save with date to allow for later error and change analysis.
     # with open(f"{PATH_METADATA}{TODAY_DATE}.json", "wb") as file:
     #     file.write(res.content)
     data = json.loads(res.text)
-    data = pd.DataFrame(data["dataset"])
-    return data
+    # Keep the datasets as plain dicts. Their fields of interest are nested lists
+    # and dicts anyway, so a DataFrame offers no vectorized operations on them.
+    return data["dataset"]
+
+
+@functools.lru_cache(maxsize=None)
+def read_template(template_name):
+    """Read template file from disk, at most once per run."""
+    with open(f"{TEMPLATE_FOLDER}{template_name}") as file:
+        return file.read()
+
+
+def fill_template(template, values):
+    """Replace all {{ KEY }} placeholders of a template in a single pass."""
+    # Most notebook cell lines contain no placeholder at all.
+    if "{{" not in template:
+        return template
+    return _PLACEHOLDER_RE.sub(lambda m: values.get(m.group(1), m.group(0)), template)
 
 
 def has_csv_distribution(dists):
     """Iterate over distributions and keep only CSV entries."""
-    csv_dists = [x for x in dists if "CSV" in x.get("format", "")]
-    return csv_dists or np.nan
+    return [x for x in dists if "CSV" in x.get("format", "")]
 
 
-def filter_csv(all_data):
-    """Filter out CSV distributions."""
-    data = copy.deepcopy(all_data)
-    data.distribution = data.distribution.apply(has_csv_distribution)
-    data.dropna(subset=["distribution"], inplace=True)
-    data.reset_index(drop=True, inplace=True)
-    return data
+def filter_csv(data):
+    """Filter out CSV distributions and drop datasets without any."""
+    for rec in data:
+        rec["distribution"] = has_csv_distribution(rec["distribution"])
+    return [rec for rec in data if rec["distribution"]]
 
 
 def sort_data(data):
     """Sort by integer prefix of identifier."""
-    data["id_short"] = data.identifier.apply(lambda x: x.split("@")[0]).astype(int)
-    data.sort_values("id_short", inplace=True)
-    data.reset_index(drop=True, inplace=True)
-    return data
+    return sorted(data, key=lambda rec: int(rec["identifier"].partition("@")[0]))
 
 
 def prepare_data_for_codebooks(data):
-    """Prepare metadata from catalogue in order to create code files."""
-    data["metadata"] = None
-    data["contact"] = None
-    data["distributions"] = None
-    data["distribution_links"] = None
+    """Prepare metadata from catalogue in order to create code files.
+
+    Only the fields needed to write the code files and README are kept.
+    """
+    prepared = []
 
     # Iterate over all datasets and compose refined data for markdown and code cells.
-    for idx in tqdm(data.index):
-        md = [f"- **{k.capitalize()}** `{data.loc[idx, k]}`\n" for k in KEYS_DATASET]
-        data.loc[idx, "metadata"] = "".join(md)
-        contact_data = data.loc[idx, "contactPoint"][0].values()
+    for rec in tqdm(data):
+        metadata = "".join(f"{label}{rec.get(k)}`\n" for k, label in _DATASET_LABELS)
+        contact_data = rec["contactPoint"][0].values()
         contact_data = [x for x in contact_data if x != None]
-        data.loc[idx, "contact"] = " | ".join(contact_data)
 
         tmp_dists = []
         tmp_links = []
-        for dist in data.loc[idx, "distribution"]:
+        for dist in rec["distribution"]:
             # Remove line breaks of description since these break the comment blocks.
             if dist["description"] != None:
-                dist["description"] = re.sub(r"\n+", " ", dist["description"])
-            md = [f"# {k.capitalize():<25}: {dist[k]}\n" for k in KEYS_DISTRIBUTION]
+                dist["description"] = _NEWLINE_RE.sub(" ", dist["description"])
+            md = [f"{label}{dist[k]}\n" for k, label in _DISTRIBUTION_LABELS]
             tmp_dists.append("".join(md))
             tmp_links.append(dist["downloadUrl"])
 
-        # Use .at[] to properly add a list as value to row.
-        # https://stackoverflow.com/a/53299945/7117003
-        data.at[idx, "distributions"] = tmp_dists
-        data.at[idx, "distribution_links"] = tmp_links
+        # Drop all other catalogue fields such as publisher, theme or keyword.
+        prepared.append(
+            {
+                "identifier": rec["identifier"],
+                "title": rec["title"],
+                "description": rec["description"],
+                "metadata": metadata,
+                "contact": " | ".join(contact_data),
+                "distributions": tmp_dists,
+                "distribution_links": tmp_links,
+            }
+        )
+
+    return prepared
+
+
+def sanitize_texts(data):
+    """Prepare cleaned variants of text fields for the code files and README."""
+    # Bind global to a local name, since the loop runs for every dataset.
+    title_max_chars = TITLE_MAX_CHARS
+    for rec in data:
+        # Replace double quotes for the Python notebooks.
+        for key in ["title", "description", "metadata"]:
+            rec[f"{key}_py"] = rec[key].replace('"', "'")
+
+        # Remove square brackets from title, since these break markdown links.
+        title_clean = rec["title"].replace("[", " ").replace("]", " ")
+        if len(title_clean) > title_max_chars:
+            title_clean = title_clean[:title_max_chars] + "…"
+        rec["title_clean"] = title_clean
 
     return data
 
 
-def create_python_notebooks(data):
-    """Create Jupyter Notebooks with Python starter code."""
-    with open(f"{TEMPLATE_FOLDER}{TEMPLATE_PYTHON}") as file:
-        py_nb_template = file.read()
-
-    for idx in tqdm(data.index):
-        py_nb = py_nb_template
-        # Populate template with metadata.
-        identifier = data.loc[idx, "identifier"]
-        py_nb = py_nb.replace("{{ PROVIDER }}", PROVIDER)
-        py_nb = py_nb.replace(
-            "{{ DATASET_TITLE }}", re.sub('"', "'", data.loc[idx, "title"])
+# Set in each worker process by _init_worker().
+_worker_render_func = None
+_worker_args = ()
+
+
+def _init_worker(render_func, args):
+    """Hand the template over to a worker process once instead of per dataset."""
+    global _worker_render_func, _worker_args
+    _worker_render_func = render_func
+    _worker_args = args
+
+
+def write_file(path_content):
+    """Save content given as (path, bytes) to disk."""
+    path, content = path_content
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+def _run_worker(chunk):
+    """Render all datasets of a chunk, then write the files concurrently."""
+    files = [_worker_render_func(rec, *_worker_args) for rec in chunk]
+    # File writes release the GIL, so threads suffice here.
+    with ThreadPoolExecutor(max_workers=WRITE_THREADS) as executor:
+        list(executor.map(write_file, files))
+    return len(chunk)
+
+
+def process_in_parallel(render_func, data, *args):
+    """Create one code file per dataset, distributed across all CPU cores.
+
+    render_func returns the (path, bytes) of the file for a single dataset.
+    Additional args (e.g. the template) are passed to render_func for every dataset.
+    """
+    # Send only the fields needed by the templates to the worker processes.
+    records = [{k: rec[k] for k in CODEBOOK_KEYS} for rec in data]
+    chunks = [
+        records[i : i + PARALLEL_CHUNK_SIZE]
+        for i in range(0, len(records), PARALLEL_CHUNK_SIZE)
+    ]
+    with ProcessPoolExecutor(
+        initializer=_init_worker, initargs=(render_func, args)
+    ) as executor, tqdm(total=len(records)) as progress:
+        for count in executor.map(_run_worker, chunks):
+            progress.update(count)
+
+
+def render_python_notebook(rec, py_nb_template, dist_cell_idx):
+    """Populate notebook template for a single dataset."""
+    py_nb = copy.deepcopy(py_nb_template)
+    identifier = rec["identifier"]
+    ds_link = f"[Direct data shop link for dataset]({BASELINK_DATASHOP}{identifier})"
+    replacements = {
+        "PROVIDER": PROVIDER,
+        "DATASET_TITLE": rec["title_py"],
+        "DATASET_DESCRIPTION": rec["description_py"],
+        "DATASET_IDENTIFIER": identifier,
+        "DATASET_METADATA": rec["metadata_py"],
+        "DISTRIBUTION_COUNT": str(len(rec["distributions"])),
+        "DATASHOP_LINK": ds_link,
+        "CONTACT": rec["contact"],
+    }
+
+    # Populate template with metadata.
+    # Replacing within the cell sources rather than in the serialized notebook
+    # keeps the JSON valid regardless of the inserted values.
+    for cell in py_nb["cells"]:
+        cell["source"] = [fill_template(line, replacements) for line in cell["source"]]
+
+    # Create metadata and code blocks for each CSV distribution.
+    # A blank line separates the blocks of the individual distributions.
+    code_block = "".join(
+        f"# Distribution {id_dist}\n{dist}\ndf = get_dataset('{dist_link}')\n\n"
+        for id_dist, (dist, dist_link) in enumerate(
+            zip(rec["distributions"], rec["distribution_links"])
         )
+    )
+    py_nb["cells"][dist_cell_idx]["source"] = code_block
 
-        py_nb = py_nb.replace(
-            "{{ DATASET_DESCRIPTION }}", re.sub('"', "'", data.loc[idx, "description"])
-        )
-        py_nb = py_nb.replace("{{ DATASET_IDENTIFIER }}", identifier)
-        py_nb = py_nb.replace(
-            "{{ DATASET_METADATA }}", re.sub('"', "'", data.loc[idx, "metadata"])
-        )
-        py_nb = py_nb.replace(
-            "{{ DISTRIBUTION_COUNT }}", str(len(data.loc[idx, "distributions"]))
-        )
+    return f"{TEMP_PREFIX}{REPO_PYTHON_OUTPUT}{identifier}.ipynb", orjson.dumps(py_nb)
 
-        ds_link = (
-            f"[Direct data shop link for dataset]({BASELINK_DATASHOP}{identifier})"
-        )
-        py_nb = py_nb.replace("{{ DATASHOP_LINK }}", ds_link)
-        py_nb = py_nb.replace("{{ CONTACT }}", data.loc[idx, "contact"])
-
-        # To properly populate the code cell for data set import
-        # we need to operate on the actual JSON rather than use simple string replacement.
-        py_nb = json.loads(py_nb, strict=False)
-
-        # Find predefined code cell for distributions.
-        # This cell contains just the string '{{ DISTRIBUTION }}'
-        # This has to be set in the template.
-        for dist_idx, cell in enumerate(py_nb["cells"]):
-            if cell["source"] == ["{{ DISTRIBUTION }}"]:
-                dist_cell_idx = dist_idx
-                break
-
-        # Create metadata and code blocks for each CSV distribution.
-        code_block = []
-        for id_dist, (dist, dist_link) in enumerate(
-            zip(data.loc[idx, "distributions"], data.loc[idx, "distribution_links"])
-        ):
-            code = (
-                f"# Distribution {id_dist}\n{dist}\ndf = get_dataset('{dist_link}')\n"
-            )
-            code = "".join([f"{line}\n" for line in code.split("\n")])
-            code_block.append(code)
-        code_block = "".join(code_block)
-        py_nb["cells"][dist_cell_idx]["source"] = code_block
 
-        # Save to disk.
-        with open(f"{TEMP_PREFIX}{REPO_PYTHON_OUTPUT}{identifier}.ipynb", "w") as file:
-            file.write(json.dumps(py_nb))
+def create_python_notebooks(data):
+    """Create Jupyter Notebooks with Python starter code."""
+    # Parse the template only once and populate a fresh copy for each dataset.
+    py_nb_template = json.loads(read_template(TEMPLATE_PYTHON))
+
+    # Find predefined code cell for distributions.
+    # This cell contains just the string '{{ DISTRIBUTION }}'
+    # This has to be set in the template.
+    dist_cell_idx = next(
+        idx
+        for idx, cell in enumerate(py_nb_template["cells"])
+        if cell["source"] == ["{{ DISTRIBUTION }}"]
+    )
 
+    process_in_parallel(render_python_notebook, data, py_nb_template, dist_cell_idx)
+
+
+def render_rmarkdown(rec, rmd_template):
+    """Populate R Markdown template for a single dataset."""
+    identifier = rec["identifier"]
+    ds_link = f"[Direct data shop link for dataset]({BASELINK_DATASHOP}{identifier})"
+
+    # Create code blocks for all distributions.
+    code_block = []
+    for id_dist, (dist, dist_link) in enumerate(
+        zip(rec["distributions"], rec["distribution_links"])
+    ):
+        code = f"# Distribution {id_dist}\n{dist}\ndf <- read_delim('{dist_link}')\n\n"
+        code_block.append(code)
+    code_block = "".join(code_block)
+
+    # Populate template with metadata.
+    rmd = fill_template(
+        rmd_template,
+        {
+            "DATASET_TITLE": rec["title"],
+            "PROVIDER": PROVIDER,
+            "TODAY_DATE": TODAY_DATE,
+            "DATASET_IDENTIFIER": identifier,
+            "DATASET_DESCRIPTION": rec["description"],
+            "DATASET_METADATA": rec["metadata"],
+            "CONTACT": rec["contact"],
+            "DISTRIBUTION_COUNT": str(len(rec["distributions"])),
+            "DATASHOP_LINK": ds_link,
+            "DISTRIBUTIONS": code_block,
+        },
+    )
 
-def create_rmarkdown(data):
-    """Create R Markdown files with R starter code."""
-    with open(f"{TEMPLATE_FOLDER}{TEMPLATE_RMARKDOWN}") as file:
-        rmd_template = file.read()
-
-    for idx in tqdm(data.index):
-        rmd = rmd_template
-        # Populate template with metadata.
-        identifier = data.loc[idx, "identifier"]
-        rmd = rmd.replace("{{ DATASET_TITLE }}", data.loc[idx, "title"])
-        rmd = rmd.replace("{{ PROVIDER }}", PROVIDER)
-        rmd = rmd.replace("{{ TODAY_DATE }}", TODAY_DATE)
-        rmd = rmd.replace("{{ DATASET_IDENTIFIER }}", identifier)
-        rmd = rmd.replace("{{ DATASET_DESCRIPTION }}", data.loc[idx, "description"])
-        rmd = rmd.replace("{{ DATASET_METADATA }}", data.loc[idx, "metadata"])
-
-        rmd = rmd.replace("{{ CONTACT }}", data.loc[idx, "contact"])
-        rmd = rmd.replace(
-            "{{ DISTRIBUTION_COUNT }}", str(len(data.loc[idx, "distributions"]))
-        )
+    return f"{TEMP_PREFIX}{REPO_R_MARKDOWN_OUTPUT}{identifier}.Rmd", rmd.encode()
 
-        ds_link = (
-            f"[Direct data shop link for dataset]({BASELINK_DATASHOP}{identifier})"
-        )
-        rmd = rmd.replace("{{ DATASHOP_LINK }}", ds_link)
 
-        # Create code blocks for all distributions.
-        code_block = []
-        for id_dist, (dist, dist_link) in enumerate(
-            zip(data.loc[idx, "distributions"], data.loc[idx, "distribution_links"])
-        ):
-            code = (
-                f"# Distribution {id_dist}\n{dist}\ndf <- read_delim('{dist_link}')\n\n"
-            )
-            code_block.append(code)
-        code_block = "".join(code_block)
-        rmd = rmd.replace("{{ DISTRIBUTIONS }}", "".join(code_block))
-
-        # Save to disk.
-        with open(
-            f"{TEMP_PREFIX}{REPO_R_MARKDOWN_OUTPUT}{identifier}.Rmd", "w"
-        ) as file:
-            file.write("".join(rmd))
+def create_rmarkdown(data):
+    """Create R Markdown files with R starter code."""
+    process_in_parallel(render_rmarkdown, data, read_template(TEMPLATE_RMARKDOWN))
 
 
 def get_header(dataset_count):
     """Retrieve header template and populate with date and count of data records."""
-    with open(f"{TEMPLATE_FOLDER}{TEMPLATE_HEADER}") as file:
-        header = file.read()
-    header = re.sub("{{ DATASET_COUNT }}", str(int(dataset_count)), header)
-    header = re.sub("{{ TODAY_DATE }}", TODAY_DATETIME, header)
-    return header
+    return fill_template(
+        read_template(TEMPLATE_HEADER),
+        {"DATASET_COUNT": str(int(dataset_count)), "TODAY_DATE": TODAY_DATETIME},
+    )
 
 
 def create_overview(data):
@@ -252,49 +350,38 @@ def create_overview(data):
     baselink_r_gh = f"https://github.com/{GITHUB_ACCOUNT}/{REPO_NAME}/blob/{REPO_BRANCH}/{REPO_R_MARKDOWN_OUTPUT}"
     baselink_py_gh = f"https://github.com/{GITHUB_ACCOUNT}/{REPO_NAME}/blob/{REPO_BRANCH}/{REPO_PYTHON_OUTPUT}"
     baselink_py_colab = f"https://githubtocolab.com/{GITHUB_ACCOUNT}/{REPO_NAME}/blob/{REPO_BRANCH}/{REPO_PYTHON_OUTPUT}"
+    # Bind global to a local name, since format_row() runs for every dataset.
+    baselink_datashop = BASELINK_DATASHOP
 
-    header = get_header(len(data))
-
-    md_doc = []
-    md_doc.append(header)
-    md_doc.append(
-        f"| ID | Title (abbreviated to {TITLE_MAX_CHARS} chars) | Python Colab | Python GitHub | R GitHub |\n"
-    )
-    md_doc.append("| :-- | :-- | :-- | :-- | :-- |\n")
-
-    for idx in tqdm(data.index):
-        identifier = data.loc[idx, "identifier"]
-        # Remove square brackets from title, since these break markdown links.
-        title_clean = data.loc[idx, "title"].replace("[", " ").replace("]", " ")
-        if len(title_clean) > TITLE_MAX_CHARS:
-            title_clean = title_clean[:TITLE_MAX_CHARS] + "…"
-
-        ds_link = f"{BASELINK_DATASHOP}{identifier}"
+    def format_row(rec):
+        identifier = rec["identifier"]
+        ds_link = f"{baselink_datashop}{identifier}"
 
         r_gh_link = f"[R GitHub]({baselink_r_gh}{identifier}.Rmd)"
         py_gh_link = f"[Python GitHub]({baselink_py_gh}{identifier}.ipynb)"
         py_colab_link = f"[![Open In Colab](https://colab.research.google.com/assets/colab-badge.svg)]({baselink_py_colab}{identifier}.ipynb)"
 
-        md_doc.append(
-            f"| {identifier.split('@')[0]} | [{title_clean}]({ds_link}) | {py_colab_link} | {py_gh_link} | {r_gh_link} |\n"
-        )
-
-    md_doc = "".join(md_doc)
+        return f"| {identifier.split('@')[0]} | [{rec['title_clean']}]({ds_link}) | {py_colab_link} | {py_gh_link} | {r_gh_link} |\n"
 
+    # Write rows straight to the file rather than collecting the whole document first.
     with open(f"{TEMP_PREFIX}README.md", "w") as file:
-        file.write(md_doc)
+        file.write(get_header(len(data)))
+        file.write(
+            f"| ID | Title (abbreviated to {TITLE_MAX_CHARS} chars) | Python Colab | Python GitHub | R GitHub |\n"
+        )
+        file.write("| :-- | :-- | :-- | :-- | :-- |\n")
+        file.writelines(format_row(rec) for rec in tqdm(data))
 
 
 # CREATE CODE FILES ---------------------------------------------------------- #
 
 
 def main():
-    datasets = (
-        get_current_json()
-        .pipe(filter_csv)
-        .pipe(sort_data)
-        .pipe(prepare_data_for_codebooks)
-    )
+    datasets = get_current_json()
+    datasets = filter_csv(datasets)
+    datasets = sort_data(datasets)
+    datasets = prepare_data_for_codebooks(datasets)
+    datasets = sanitize_texts(datasets)
 
     create_python_notebooks(datasets)
     create_rmarkdown(datasets)